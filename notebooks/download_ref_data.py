@@ -2,11 +2,8 @@
 # SPDX-License-Identifier: Apache-2.0
 
 from nbhelpers import nbhelpers
-import boto3
 import argparse
 
-batch = boto3.client("batch")
-
 def _parse_args():
 
     parser = argparse.ArgumentParser()
@@ -48,7 +45,7 @@ def submit_download_data_job(
         ],
     }
 
-    response = batch.submit_job(
+    response = nbhelpers.batch.submit_job(
         jobDefinition=job_definition,
         jobName=job_name,
         jobQueue=job_queue,
@@ -5,14 +5,18 @@
 Helper functions for the AWS-Alphafold notebook.
 """
 from datetime import datetime
+from dateutil.tz import tzlocal
+from functools import lru_cache
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
 import uuid
 import sagemaker
 from Bio import SeqIO
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
-from Bio import AlignIO
-from Bio.Align import MultipleSeqAlignment
 import os
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -27,10 +31,24 @@ import re
 boto_session = boto3.session.Session()
 sm_session = sagemaker.session.Session(boto_session)
 region = boto_session.region_name
-s3 = boto_session.client("s3", region_name=region)
-batch = boto_session.client("batch", region_name=region)
-cfn = boto_session.client("cloudformation", region_name=region)
-logs_client = boto_session.client("logs")
+## Size the connection pool for the threaded downloads and job submissions
+client_config = Config(
+    max_pool_connections=50, retries={"max_attempts": 10, "mode": "adaptive"}
+)
+s3 = boto_session.client("s3", region_name=region, config=client_config)
+batch = boto_session.client("batch", region_name=region, config=client_config)
+cfn = boto_session.client("cloudformation", region_name=region, config=client_config)
+logs_client = boto_session.client("logs", config=client_config)
+transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    max_concurrency=16,
+    multipart_chunksize=16 * 1024 * 1024,
+    io_chunksize=1024 * 1024,
+    use_threads=True,
+)
+
+invalid_job_name_chars = re.compile(r"\W")
+invalid_residue_chars = re.compile("[^ARNDCQEGHILKMFPSTWYV]")
 
 
 def create_job_name(suffix=None):
@@ -44,140 +62,246 @@ def create_job_name(suffix=None):
     else:
         ## Ensure that the suffix conforms to the Batch requirements, (only letters,
         ## numbers, hyphens, and underscores are allowed).
-        suffix = re.sub("\W", "_", suffix)
+        suffix = invalid_job_name_chars.sub("_", suffix)
         return datetime.now().strftime("%Y%m%dT%H%M%S") + "_" + suffix
 
 
+@lru_cache()
+def default_bucket():
+    """
+    Look up the SageMaker default bucket on first use rather than at import.
+    """
+    return sm_session.default_bucket()
+
+
 def upload_fasta_to_s3(
     sequences,
     ids,
-    bucket=sm_session.default_bucket(),
-    job_name=uuid.uuid4(),
+    bucket=None,
+    job_name=None,
     region="us-east-1",
 ):
 
     """
-    Create a fasta file and upload it to S3.
+    Create a fasta file in memory and upload it to S3.
     """
 
-    file_out = "_tmp.fasta"
-    with open(file_out, "a") as f_out:
-        for i, seq in enumerate(sequences):
-            seq_record = SeqRecord(Seq(seq), id=ids[i])
-            SeqIO.write(seq_record, f_out, "fasta")
+    if bucket is None:
+        bucket = default_bucket()
+    if job_name is None:
+        job_name = uuid.uuid4().hex
+    if len(ids) != len(sequences):
+        raise ValueError(
+            f"Got {len(sequences)} sequences but {len(ids)} ids; each sequence needs an id."
+        )
+
+    fasta = StringIO()
+    SeqIO.write(
+        (SeqRecord(Seq(seq), id=id) for seq, id in zip(sequences, ids)),
+        fasta,
+        "fasta",
+    )
 
     object_key = f"{job_name}/{job_name}.fasta"
-    response = s3.upload_file(file_out, bucket, object_key)
-    os.remove(file_out)
+    s3.upload_fileobj(
+        BytesIO(fasta.getvalue().encode("utf-8")),
+        bucket,
+        object_key,
+        Config=transfer_config,
+    )
     s3_uri = f"s3://{bucket}/{object_key}"
     print(f"Sequence file uploaded to {s3_uri}")
     return object_key
 
 
-def list_alphafold_stacks():
-    af_stacks = []
-    for stack in cfn.list_stacks(
-        StackStatusFilter=["CREATE_COMPLETE", "UPDATE_COMPLETE"]
-    )["StackSummaries"]:
-        if "Alphafold on AWS Batch" in stack["TemplateDescription"]:
-            af_stacks.append(stack)
-    return af_stacks
+@lru_cache()
+def lookup_alphafold_stacks():
+    """
+    Query CloudFormation for the active stacks created from the AlphaFold template.
+    """
+    paginator = cfn.get_paginator("list_stacks")
+    return [
+        stack
+        for page in paginator.paginate(
+            StackStatusFilter=["CREATE_COMPLETE", "UPDATE_COMPLETE"]
+        )
+        for stack in page["StackSummaries"]
+        if "Alphafold on AWS Batch" in stack.get("TemplateDescription", "")
+    ]
 
 
+def list_alphafold_stacks():
+    """
+    List the active CloudFormation stacks created from the AlphaFold template.
+    Results are cached for the session once a stack is found; call
+    clear_stack_cache() after creating, updating, or deleting a stack.
+    """
+    af_stacks = lookup_alphafold_stacks()
+    if not af_stacks:
+        ## Don't keep an empty result, so a stack that is still being created
+        ## is picked up on the next call.
+        lookup_alphafold_stacks.cache_clear()
+    return list(af_stacks)
+
+
+## Result keys for the Batch resources in the AlphaFold stack, by logical id
+batch_resource_names = {
+    "GPUFoldingJobDefinition": "gpu_job_definition",
+    "PrivateGPUJobQueue": "gpu_job_queue",
+    "CPUFoldingJobDefinition": "cpu_job_definition",
+    "PrivateCPUJobQueue": "cpu_job_queue",
+    "CPUDownloadJobDefinition": "download_job_definition",
+    "PublicCPUJobQueue": "download_job_queue",
+}
+
+
+@lru_cache(maxsize=8)
 def get_batch_resources(stack_name):
     """
     Get the resource names of the Batch resources for running Alphafold jobs.
+    Results are cached for the session; call clear_stack_cache() after
+    creating, updating, or deleting a stack.
     """
 
-    # stack_name = af_stacks[0]["StackName"]
-    stack_resources = cfn.list_stack_resources(StackName=stack_name)
-    for resource in stack_resources["StackResourceSummaries"]:
-        if resource["LogicalResourceId"] == "GPUFoldingJobDefinition":
-            gpu_job_definition = resource["PhysicalResourceId"]
-        if resource["LogicalResourceId"] == "PrivateGPUJobQueue":
-            gpu_job_queue = resource["PhysicalResourceId"]
-        if resource["LogicalResourceId"] == "CPUFoldingJobDefinition":
-            cpu_job_definition = resource["PhysicalResourceId"]
-        if resource["LogicalResourceId"] == "PrivateCPUJobQueue":
-            cpu_job_queue = resource["PhysicalResourceId"]
-        if resource["LogicalResourceId"] == "CPUDownloadJobDefinition":
-            download_job_definition = resource["PhysicalResourceId"]
-        if resource["LogicalResourceId"] == "PublicCPUJobQueue":
-            download_job_queue = resource["PhysicalResourceId"]
+    paginator = cfn.get_paginator("list_stack_resources")
+    physical_ids = {
+        resource["LogicalResourceId"]: resource["PhysicalResourceId"]
+        for page in paginator.paginate(StackName=stack_name)
+        for resource in page["StackResourceSummaries"]
+    }
     return {
-        "gpu_job_definition": gpu_job_definition,
-        "gpu_job_queue": gpu_job_queue,
-        "cpu_job_definition": cpu_job_definition,
-        "cpu_job_queue": cpu_job_queue,
-        "download_job_definition": download_job_definition,
-        "download_job_queue": download_job_queue,
+        name: physical_ids[logical_id]
+        for logical_id, name in batch_resource_names.items()
     }
 
 
-def get_batch_job_info(jobId):
-
+def clear_stack_cache():
     """
-    Retrieve and format information about a batch job.
+    Clear the cached CloudFormation stack and Batch resource lookups.
     """
+    lookup_alphafold_stacks.cache_clear()
+    get_batch_resources.cache_clear()
+
+
+def format_batch_job_info(job):
 
-    job_description = batch.describe_jobs(jobs=[jobId])
+    """
+    Format the description of a batch job.
+    """
 
     output = {
-        "jobArn": job_description["jobs"][0]["jobArn"],
-        "jobName": job_description["jobs"][0]["jobName"],
-        "jobId": job_description["jobs"][0]["jobId"],
-        "status": job_description["jobs"][0]["status"],
-        "createdAt": datetime.utcfromtimestamp(
-            job_description["jobs"][0]["createdAt"] / 1000
-        ).strftime("%Y-%m-%dT%H:%M:%SZ"),
-        "dependsOn": job_description["jobs"][0]["dependsOn"],
-        "tags": job_description["jobs"][0]["tags"],
+        "jobArn": job["jobArn"],
+        "jobName": job["jobName"],
+        "jobId": job["jobId"],
+        "status": job["status"],
+        "createdAt": datetime.utcfromtimestamp(job["createdAt"] / 1000).strftime(
+            "%Y-%m-%dT%H:%M:%SZ"
+        ),
+        "dependsOn": job["dependsOn"],
+        "tags": job["tags"],
     }
 
     if output["status"] in ["STARTING", "RUNNING", "SUCCEEDED", "FAILED"]:
-        output["logStreamName"] = job_description["jobs"][0]["container"][
-            "logStreamName"
-        ]
+        output["logStreamName"] = job["container"]["logStreamName"]
     return output
 
 
-def get_batch_logs(logStreamName):
+def get_batch_jobs_info(jobIds):
 
     """
-    Retrieve and format logs for batch job.
+    Retrieve and format information about several batch jobs, describing up to
+    100 jobs (the DescribeJobs limit) per request. Results follow the order of
+    jobIds; ids that Batch does not return are left out.
     """
 
-    try:
-        response = logs_client.get_log_events(
-            logGroupName="/aws/batch/job", logStreamName=logStreamName
-        )
-    except logs_client.meta.client.exceptions.ResourceNotFoundException:
-        return f"Log stream {logStreamName} does not exist. Please try again in a few minutes"
+    jobIds = list(jobIds)
+    jobs = {}
+    for i in range(0, len(jobIds), 100):
+        for job in batch.describe_jobs(jobs=jobIds[i : i + 100])["jobs"]:
+            jobs[job["jobId"]] = job
+    return [format_batch_job_info(jobs[jobId]) for jobId in jobIds if jobId in jobs]
+
 
-    logs = pd.DataFrame.from_dict(response["events"])
-    logs.timestamp = logs.timestamp.transform(
-        lambda x: datetime.fromtimestamp(x / 1000)
+def get_batch_job_info(jobId):
+
+    """
+    Retrieve and format information about a batch job.
+    """
+
+    return get_batch_jobs_info([jobId])[0]
+
+
+def get_batch_logs(logStreamName):
+
+    """
+    Retrieve and format logs for batch job. Timestamps are in local time.
+    """
+
+    timestamps, messages = [], []
+    kwargs = {
+        "logGroupName": "/aws/batch/job",
+        "logStreamName": logStreamName,
+        "startFromHead": True,
+    }
+    while True:
+        try:
+            response = logs_client.get_log_events(**kwargs)
+        except logs_client.exceptions.ResourceNotFoundException:
+            return f"Log stream {logStreamName} does not exist. Please try again in a few minutes"
+        for event in response["events"]:
+            timestamps.append(event["timestamp"])
+            messages.append(event["message"])
+        ## The forward token stops changing once the end of the stream is reached
+        if response["nextForwardToken"] == kwargs.get("nextToken"):
+            break
+        kwargs["nextToken"] = response["nextForwardToken"]
+
+    return pd.DataFrame(
+        {
+            "timestamp": pd.to_datetime(timestamps, unit="ms", utc=True)
+            .tz_convert(tzlocal())
+            .tz_localize(None),
+            "message": messages,
+        }
     )
-    logs.drop("ingestionTime", axis=1, inplace=True)
-    return logs
 
 
-def download_dir(client, bucket, local="data", prefix=""):
-    """Recursively download files from S3."""
+def download_dir(client, bucket, local="data", prefix="", max_workers=4):
+    """Recursively download files from S3, several files at a time."""
+
+    ## Split the client's connection pool between the concurrent file downloads
+    ## so the total number of transfer threads never exceeds it.
+    pool_size = client.meta.config.max_pool_connections
+    max_workers = max(1, min(max_workers, pool_size))
+    config = TransferConfig(
+        multipart_threshold=transfer_config.multipart_threshold,
+        max_concurrency=max(1, pool_size // max_workers),
+        multipart_chunksize=transfer_config.multipart_chunksize,
+        io_chunksize=transfer_config.io_chunksize,
+        use_threads=True,
+    )
 
     paginator = client.get_paginator("list_objects_v2")
-    file_count = 0
-    for result in paginator.paginate(Bucket=bucket, Delimiter="/", Prefix=prefix):
-        if result.get("CommonPrefixes") is not None:
-            for subdir in result.get("CommonPrefixes"):
-                download_dir(client, bucket, local, subdir.get("Prefix"))
+    downloads = []
+    for result in paginator.paginate(Bucket=bucket, Prefix=prefix):
         for file in result.get("Contents", []):
+            if file.get("Key").endswith("/"):
+                continue
             dest_pathname = os.path.join(local, file.get("Key"))
-            if not os.path.exists(os.path.dirname(dest_pathname)):
-                os.makedirs(os.path.dirname(dest_pathname))
-            client.download_file(bucket, file.get("Key"), dest_pathname)
-            file_count += 1
-    print(f"{file_count} files downloaded from s3.")
+            os.makedirs(os.path.dirname(dest_pathname), exist_ok=True)
+            downloads.append((file.get("Key"), dest_pathname))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        ## Consume the iterator so that any download errors are raised here.
+        list(
+            executor.map(
+                lambda download: client.download_file(
+                    bucket, download[0], download[1], Config=config
+                ),
+                downloads,
+            )
+        )
+    print(f"{len(downloads)} files downloaded from s3.")
     return local
 
 
@@ -190,9 +314,36 @@ def reduce_stockholm_file(sto_file):
     """Read in a .sto file and parse format it into a numpy array of the
     same length as the first (target) sequence
     """
-    msa = AlignIO.read(sto_file, "stockholm")
-    msa_arr = np.array([list(rec) for rec in msa])
-    return msa_arr[:, msa_arr[0, :] != "-"]
+    ## Only the residues are needed, so read the sequence lines directly instead
+    ## of building Biopython records. A sequence may be split across several
+    ## blocks, so collect the pieces by name.
+    blocks = {}
+    with open(sto_file, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith(b"#") or line == b"//":
+                continue
+            name, seq = line.split()
+            blocks.setdefault(name, []).append(seq)
+    ## Build the array with one byte per residue. Gaps in insert columns are
+    ## written as "." and treated as "-".
+    sequences = [b"".join(seq).replace(b".", b"-") for seq in blocks.values()]
+    msa_arr = np.array(sequences, dtype="S").view("S1").reshape(len(sequences), -1)
+    return msa_arr[:, msa_arr[0, :] != b"-"]
+
+
+aa_lut = np.full(256, 27, dtype=np.int8)
+aa_lut[np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ-", dtype=np.uint8)] = np.arange(27)
+
+
+def count_non_gaps(msa_arr, gap, block_size=4096):
+    """Count the non-gap entries in each column of an encoded MSA array, working
+    in blocks of rows so the boolean comparison never spans the full MSA
+    """
+    counts = np.zeros(msa_arr.shape[1], dtype=np.int32)
+    for start in range(0, len(msa_arr), block_size):
+        counts += np.count_nonzero(msa_arr[start : start + block_size] != gap, axis=0)
+    return counts
 
 
 def plot_msa_array(msa_arr, id=None):
@@ -200,13 +351,14 @@ def plot_msa_array(msa_arr, id=None):
     total_msa_size = len(msa_arr)
 
     if total_msa_size > 1:
-        aa_map = {res: i for i, res in enumerate("ABCDEFGHIJKLMNOPQRSTUVWXYZ-")}
-        msa_arr = np.array([[aa_map[aa] for aa in seq] for seq in msa_arr])
+        ## Map residue characters to indices with a byte lookup table instead of
+        ## a per-residue dict lookup. Unknown characters map to 27.
+        msa_arr = aa_lut[np.asarray(msa_arr, dtype="S1").view(np.uint8)]
         plt.figure(figsize=(12, 3))
         plt.title(
             f"Per-Residue Count of Non-Gap Amino Acids in the MSA for Sequence {id}"
         )
-        plt.plot(np.sum(msa_arr != aa_map["-"], axis=0), color="black")
+        plt.plot(count_non_gaps(msa_arr, aa_lut[ord("-")]), color="black")
         plt.ylabel("Non-Gap Count")
         plt.yticks(range(0, total_msa_size + 1, max(1, int(total_msa_size / 3))))
 
@@ -308,11 +460,14 @@ def submit_batch_alphafold_job(
     gpu=1,
     depends_on=None,
     stack_name=None,
+    batch_resources=None,
+    verbose=True,
 ):
 
-    if stack_name is None:
-        stack_name = list_alphafold_stacks()[0]["StackName"]
-    batch_resources = get_batch_resources(stack_name)
+    if batch_resources is None:
+        if stack_name is None:
+            stack_name = list_alphafold_stacks()[0]["StackName"]
+        batch_resources = get_batch_resources(stack_name)
 
     container_overrides = {
         "command": [
@@ -388,7 +543,8 @@ def submit_batch_alphafold_job(
         job_definition = batch_resources["cpu_job_definition"]
         job_queue = batch_resources["cpu_job_queue"]
 
-    print(container_overrides)
+    if verbose:
+        print(container_overrides)
     if depends_on is None:
         response = batch.submit_job(
             jobDefinition=job_definition,
@@ -408,6 +564,42 @@ def submit_batch_alphafold_job(
     return response
 
 
+def submit_batch_alphafold_jobs(jobs, stack_name=None, max_workers=16, **kwargs):
+
+    """
+    Submit several AlphaFold jobs in parallel. Each item in jobs is a dict of
+    submit_batch_alphafold_job arguments, e.g. job_name and fasta_paths; any
+    other keyword arguments are shared by every job.
+
+    Returns two lists in the same order as jobs: the submit_job responses (None
+    where a submission failed) and the exceptions (None where it succeeded), so
+    the jobs that were queued can still be tracked if others fail.
+    """
+
+    if stack_name is None:
+        stack_name = list_alphafold_stacks()[0]["StackName"]
+    batch_resources = get_batch_resources(stack_name)
+
+    def submit_one(job):
+        ## Don't print the overrides from many threads at once unless asked to
+        return submit_batch_alphafold_job(
+            **{"verbose": False, **kwargs, **job}, batch_resources=batch_resources
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(submit_one, job) for job in jobs]
+
+    errors = [future.exception() for future in futures]
+    responses = [
+        None if error is not None else future.result()
+        for future, error in zip(futures, errors)
+    ]
+    failed = sum(error is not None for error in errors)
+    if failed:
+        print(f"{failed} of {len(futures)} job submissions failed.")
+    return responses, errors
+
+
 def get_run_metrics(bucket, job_name):
     timings_uri = sagemaker.s3.s3_path_join(bucket, job_name, "timings.json")
     ranking_uri = sagemaker.s3.s3_path_join(bucket, job_name, "ranking_debug.json")
@@ -429,7 +621,7 @@ def validate_input(input_sequences):
     output = []
     for sequence in input_sequences:
         sequence = sequence.upper().strip()
-        if re.search("[^ARNDCQEGHILKMFPSTWYV]", sequence):
+        if invalid_residue_chars.search(sequence):
             raise ValueError(
                 f"Input sequence contains invalid amino acid symbols." f"{sequence}"
             )
@@ -497,6 +689,13 @@ pymol_color_list = [
 
 alphabet_list = list(ascii_uppercase + ascii_lowercase)
 
+
+@lru_cache()
+def chain_color_map(chains):
+    """Map the first chains chain ids to their pymol colors"""
+    return dict(zip(alphabet_list[:chains], pymol_color_list))
+
+
 def plot_pdb(
     pred_output_path,
     show_sidechains=False,
@@ -538,8 +737,14 @@ def plot_pdb(
     elif color == "rainbow":
         view.setStyle({"cartoon": {"color": "spectrum"}})
     elif color == "chain":
-        for n, chain, color in zip(range(chains), alphabet_list, pymol_color_list):
-            view.setStyle({"chain": chain}, {"cartoon": {"color": color}})
+        view.setStyle(
+            {"chain": alphabet_list[:chains]},
+            {
+                "cartoon": {
+                    "colorscheme": {"prop": "chain", "map": chain_color_map(chains)}
+                }
+            },
+        )
     if show_sidechains:
         BB = ["C", "O", "N"]
         HP = [